@@ -1,33 +1,47 @@
 #!/usr/bin/env python
 
 import argparse
+import asyncio
+from Bio import SeqIO
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet import IUPAC
-import coreapi
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from functools import partial
 from git import Repo
+import httpx
+from io import BytesIO, StringIO, TextIOWrapper
 import json
+import math
+import orjson
 import os
 import pickle
 # Download of Pfam/UniProt via RESTFUL API
-from prody.database import pfam, uniprot
+from prody.database import pfam
 import re
+import shelve
 import shutil
 import subprocess
 import sys
 import time
 from urllib.request import urlretrieve
+from zipfile import ZipFile
 
 # Defaults
 out_dir = os.path.dirname(os.path.realpath(__file__))
 root_dir = os.path.join(out_dir, os.pardir)
 
+# Regular expressions
+pfam_id_std_re = re.compile(r"^#=GF\sID\s+(\S+)$")
+pfam_ac_re = re.compile(r"^#=GF\sAC\s+(PF\d{5}).\d+$")
+
 # Append JASPAR-profile-inference to path
 sys.path.append(root_dir)
 
 # Import globals
 from __init__ import Jglobals
-from infer_profile import hmmalign, hmmscan, __make_seq_file
+from infer_profile import hmmalign, hmmsearch, load_hmms, load_profiles
 
 #-------------#
 # Functions   #
@@ -45,6 +59,8 @@ def parse_args():
         help="development mode (uses hfaistos; default = False)")
     parser.add_argument("-o", default=out_dir, metavar="DIR",
         help="output directory (default = ./)")
+    parser.add_argument("--threads", default=1, metavar="INT", type=int,
+        help="number of threads to use (default = 1)")
 
     return(parser.parse_args())
 
@@ -54,14 +70,12 @@ def main():
     args = parse_args()
 
     # Globals
-    global client
-    client = coreapi.Client()
-    global codec
-    codec = coreapi.codecs.CoreJSONCodec()
-    global cwd
-    cwd = os.getcwd()
     global devnull
     devnull = subprocess.DEVNULL
+    global max_connections
+    max_connections = 64
+    global max_pfam_connections
+    max_pfam_connections = 16
     global jaspar_url
     jaspar_url = "http://jaspar.genereg.net/"
     if args.devel:
@@ -74,19 +88,28 @@ def main():
     profiles_file_ext = ".profiles.json"
     global uniprot_file_ext
     uniprot_file_ext = ".uniprot.json"
-    out_dir = os.path.abspath(args.o)
+    global uniprot_cache_file
+    uniprot_cache_file = ".uniprot.cache"
 
     # Get files
-    get_files(out_dir)
+    get_files(args.o, args.threads)
+
+def get_files(out_dir=out_dir, threads=1):
 
-def get_files(out_dir=out_dir):
+    # Initialize
+    out_dir = os.path.abspath(out_dir)
 
     # Create output dir
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
     # Download Pfam DBD hidden Markov models
-    __download_Pfam_DBD_HMMs(out_dir)
+    __download_Pfam_DBD_HMMs(out_dir, threads)
+
+    # Load Pfam DBD hidden Markov models (i.e. once for all taxons)
+    hmm_db = os.path.join(out_dir, "pfam", "All.hmm")
+    hmms = load_hmms(hmm_db)
+    profiles = load_profiles(hmm_db)
 
     # Download Cis-BP similarity regression models
     __download_CisBP_models(out_dir)
@@ -105,9 +128,9 @@ def get_files(out_dir=out_dir):
         __format_BLAST_database(taxon, out_dir)
 
         # Get Pfam alignments
-        __get_Pfam_alignments(taxon, out_dir)
+        __get_Pfam_alignments(taxon, hmms, profiles, out_dir, threads)
 
-def __download_Pfam_DBD_HMMs(out_dir=out_dir):
+def __download_Pfam_DBD_HMMs(out_dir=out_dir, threads=1):
 
     # Skip if Pfam file already exists
     json_file = os.path.join(out_dir, "pfam.json")
@@ -125,105 +148,184 @@ def __download_Pfam_DBD_HMMs(out_dir=out_dir):
         if not os.path.isdir(pfam_dir):
             os.makedirs(pfam_dir)
 
-        # Change dir
-        os.chdir(pfam_dir)
-
-        # Skip if Cis-BP file already exists
-        if not os.path.exists(cisbp_file):
-            urlretrieve(os.path.join(url, cisbp_file), cisbp_file)
-
-        # Get DBD/cut-off pairs
-        cmd = "unzip -p %s | cut -f 11 | sort | uniq | grep -v DBDs" % \
-            cisbp_file
-        process = subprocess.run([cmd], shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-
-        # For each line...
-        for line in process.stdout.decode("utf-8").split("\n"):
-
-            # For each Pfam ID...
-            for pfam_id in line.split(","):
-
-                # Skip if not Pfam ID
-                if pfam_id == "UNKNOWN" or pfam_id == "":
+        # Download Cis-BP file (i.e. into memory)
+        zip_data = BytesIO()
+        with httpx.stream("GET", os.path.join(url, cisbp_file),
+            follow_redirects=True, timeout=None) as response:
+            response.raise_for_status()
+            for chunk in response.iter_bytes():
+                zip_data.write(chunk)
+
+        # Get Pfam IDs (i.e. DBDs in the 11th column)
+        with ZipFile(zip_data) as zf:
+            with TextIOWrapper(zf.open(zf.infolist()[0]), "utf-8") as f:
+
+                # For each line...
+                for columns in csv.reader(f, delimiter="\t",
+                    quoting=csv.QUOTE_NONE):
+
+                    # Skip header and incomplete lines
+                    if len(columns) < 11 or columns[10] == "DBDs":
+                        continue
+
+                    # For each Pfam ID...
+                    for pfam_id in columns[10].split(","):
+
+                        # Skip if not Pfam ID
+                        if pfam_id == "UNKNOWN" or pfam_id == "":
+                            continue
+
+                        # Add Pfam ID
+                        pfam_ids.add(pfam_id)
+
+        # Skip Pfam IDs already processed (i.e. by an interrupted run)
+        pfam_ids_to_fetch = []
+        for pfam_id in sorted(pfam_ids):
+            done_file = os.path.join(pfam_dir, "%s.done" % pfam_id)
+            if os.path.exists(done_file):
+                for line in Jglobals.parse_file(done_file):
+                    pfam_ac, pfam_id_std = line.split("\t")
+                    pfams.setdefault(pfam_ac, pfam_id_std)
+            else:
+                pfam_ids_to_fetch.append(pfam_id)
+
+        # Fetch MSAs from Pfam (i.e. concurrently, but w/ fewer connections to
+        # avoid rate limits)
+        with ThreadPoolExecutor(max_workers=max_pfam_connections) as executor:
+            msa_files = list(executor.map(
+                partial(__fetch_Pfam_MSA, pfam_dir=pfam_dir), pfam_ids_to_fetch
+            ))
+
+        # Build HMMs (i.e. in parallel)
+        failed_pfam_ids = []
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for pfam_id, (pfam_ac, pfam_id_std, is_built) in zip(
+                pfam_ids_to_fetch, executor.map(__build_Pfam_HMM, msa_files)):
+
+                # Skip if HMM could not be built (i.e. retry on resume)
+                if not is_built:
+                    failed_pfam_ids.append(pfam_id)
                     continue
 
-                # Add Pfam ID
-                pfam_ids.add(pfam_id)
+                # Add Pfam
+                pfams.setdefault(pfam_ac, pfam_id_std)
 
-        # For each Pfam ID...
-        for pfam_id in pfam_ids:
+                # Mark Pfam ID as processed
+                done_file = os.path.join(pfam_dir, "%s.done" % pfam_id)
+                Jglobals.write(done_file, "%s\t%s" % (pfam_ac, pfam_id_std))
 
-            # Fetch MSA from Pfam
-            attempts = 0
-            while attempts < 5:
-                try:
-                    msa_file = pfam.fetchPfamMSA(pfam_id, alignment="seed")
-                    break
-                except:
-                    # i.e. try again in 5 seconds
-                    attempts += 1
-                    time.sleep(5)
-
-            # For each line...
-            for line in Jglobals.parse_file(msa_file):
-
-                m = re.search("^#=GF\sID\s+(\S+)$", line)
-                if m:
-                    pfam_id_std = m.group(1)
-
-                m = re.search("^#=GF\sAC\s+(PF\d{5}).\d+$", line)
-                if m:
-                    pfam_ac = m.group(1)
-                    break
-
-            # HMM build
-            hmm_file = "%s.hmm" % pfam_id_std
-            cmd = "hmmbuild %s %s" % (hmm_file, msa_file)
-            process = subprocess.run([cmd], shell=True, stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL)
-
-            # HMM press
-            cmd = "hmmpress -f %s" % hmm_file
-            process = subprocess.run([cmd], shell=True, stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL)
-
-            # Add Pfam
-            pfams.setdefault(pfam_ac, pfam_id_std)
-
-            # Remove MSA file
-            os.remove(msa_file)
+        # Raise error if HMMs could not be built (i.e. before the HMM database
+        # and the Pfam file are created)
+        if failed_pfam_ids:
+            raise ValueError("Could not build Pfam HMMs: %s" % \
+                ", ".join(failed_pfam_ids))
 
         # Skip if HMM database of all DBDs already exists
-        hmm_db = "All.hmm"
+        hmm_db = os.path.join(pfam_dir, "All.hmm")
         if not os.path.exists(hmm_db):
 
-            # For each HMM file...
-            for hmm_file in os.listdir("."):
+            # Initialize
+            hmm_files = [os.path.join(pfam_dir, f)
+                for f in os.listdir(pfam_dir) if f.endswith(".hmm")]
 
-                # Skip if not HMM file
-                if not hmm_file.endswith(".hmm"): continue
+            with open(hmm_db, "wb") as out_handle:
 
-                # Add HMM to database
-                for line in Jglobals.parse_file(hmm_file):
-                    Jglobals.write(hmm_db, line)
+                # For each HMM file...
+                for hmm_file in sorted(hmm_files):
 
-            # HMM press
+                    # Add HMM to database
+                    with open(hmm_file, "rb") as in_handle:
+                        shutil.copyfileobj(in_handle, out_handle, 1 << 20)
+
+        # HMM press
+        if not __is_HMM_pressed(hmm_db):
             cmd = "hmmpress -f %s" % hmm_db
             process = subprocess.run([cmd], shell=True,
                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-        # Remove Cis-BP file
-        if os.path.exists(cisbp_file):
-            os.remove(cisbp_file)
-
         # Write
-        Jglobals.write(
-            json_file, json.dumps(pfams, sort_keys=True, indent=4)
-        )
+        __write_JSON(json_file, pfams)
+
+        # Remove sentinel files (i.e. only needed to resume interrupted runs)
+        for pfam_id in pfam_ids:
+            done_file = os.path.join(pfam_dir, "%s.done" % pfam_id)
+            if os.path.exists(done_file):
+                os.remove(done_file)
+
+def __write_JSON(json_file, obj):
+    """
+    Writes an object to a JSON file (i.e. keys are sorted and indented).
+    """
+
+    with open(json_file, "wb") as f:
+        f.write(orjson.dumps(obj, option=orjson.OPT_SORT_KEYS |
+            orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+
+def __fetch_Pfam_MSA(pfam_id, pfam_dir="."):
+
+    # Fetch MSA from Pfam
+    attempts = 0
+    while attempts < 5:
+        try:
+            return(pfam.fetchPfamMSA(pfam_id, alignment="seed",
+                folder=pfam_dir))
+        except Exception as e:
+            # i.e. try again in 5 seconds
+            error = e
+            attempts += 1
+            time.sleep(5)
+
+    raise ValueError("Could not fetch Pfam MSA: %s" % pfam_id) from error
+
+def __build_Pfam_HMM(msa_file):
+
+    # For each line...
+    for line in Jglobals.parse_file(msa_file):
+
+        m = pfam_id_std_re.match(line)
+        if m:
+            pfam_id_std = m.group(1)
+
+        m = pfam_ac_re.match(line)
+        if m:
+            pfam_ac = m.group(1)
+            break
+
+    # HMM build (i.e. one CPU per HMM, as HMMs are built in parallel)
+    hmm_file = os.path.join(os.path.dirname(msa_file), "%s.hmm" % pfam_id_std)
+    cmd = "hmmbuild --cpu 1 %s %s" % (hmm_file, msa_file)
+    process = subprocess.run([cmd], shell=True, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    is_built = process.returncode == 0 and os.path.exists(hmm_file) and \
+        os.path.getsize(hmm_file) > 0
+    if not is_built and os.path.exists(hmm_file):
+        os.remove(hmm_file)
+
+    # HMM press
+    if is_built and not __is_HMM_pressed(hmm_file):
+        cmd = "hmmpress -f %s" % hmm_file
+        process = subprocess.run([cmd], shell=True, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+
+    # Remove MSA file
+    os.remove(msa_file)
+
+    return(pfam_ac, pfam_id_std, is_built)
+
+def __is_HMM_pressed(hmm_file):
+
+    # For each pressed file...
+    for ext in [".h3m", ".h3i", ".h3f", ".h3p"]:
+
+        # Skip if pressed file exists and is newer than the HMM
+        pressed_file = hmm_file + ext
+        if os.path.exists(pressed_file):
+            if os.path.getmtime(pressed_file) >= os.path.getmtime(hmm_file):
+                continue
 
-        # Change dir
-        os.chdir(cwd)
+        return(False)
+
+    return(True)
 
 def __download_CisBP_models(out_dir=out_dir):
 
@@ -234,28 +336,24 @@ def __download_CisBP_models(out_dir=out_dir):
         # Create Cis-BP dir
         os.makedirs(cisbp_dir)
 
-        # Change dir
-        os.chdir(cisbp_dir)
-
         # Clone repo to tmp dir
         url = "https://github.com/smlmbrt/SimilarityRegression.git"
-        repo = Repo.clone_from(url, "tmp")
+        tmp_dir = os.path.join(cisbp_dir, "tmp")
+        repo = Repo.clone_from(url, tmp_dir)
 
         # For each JSON file...
-        for json_file in os.listdir(os.path.join("tmp", "SRModels")):
+        for json_file in os.listdir(os.path.join(tmp_dir, "SRModels")):
 
             # Skip
             if not json_file.endswith(".json"):
                 continue
 
             # Copy
-            shutil.copy(os.path.join("tmp", "SRModels", json_file), json_file)
+            shutil.copy(os.path.join(tmp_dir, "SRModels", json_file),
+                os.path.join(cisbp_dir, json_file))
 
         # Remove tmp dir
-        shutil.rmtree("tmp")
-
-    # Change dir
-    os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
 
 def __download_JASPAR_profiles(taxon, out_dir=out_dir):
         
@@ -266,29 +364,24 @@ def __download_JASPAR_profiles(taxon, out_dir=out_dir):
         # Create taxon directory
         os.makedirs(taxon_dir)
 
-        # Move to taxon directory
-        os.chdir(taxon_dir)
-
         # Initialize
         jaspar_file = "JASPAR2020_CORE_%s_redundant_pfms_jaspar.zip" % taxon
         if "hfaistos.uio.no:8002" in jaspar_url:
             jaspar_file = "JASPAR2020_CORE_%s_redundant_pfms_jaspar.zip" % taxon
+        zip_file = os.path.join(taxon_dir, jaspar_file)
 
         # Get JASPAR profiles
-        if not os.path.exists(jaspar_file):
+        if not os.path.exists(zip_file):
             urlretrieve(
                 os.path.join(jaspar_url, "download", "CORE", jaspar_file),
-                jaspar_file
+                zip_file
             )
 
         # Unzip
-        os.system("unzip -qq %s" % jaspar_file)
+        os.system("unzip -qq %s -d %s" % (zip_file, taxon_dir))
 
         # Remove zip files
-        os.remove("%s" % jaspar_file)
-
-        # Change dir
-        os.chdir(cwd)
+        os.remove(zip_file)
 
 def __get_profile_info(taxon, out_dir=out_dir):
 
@@ -299,11 +392,9 @@ def __get_profile_info(taxon, out_dir=out_dir):
         # Initialize
         profiles = {}
         url = os.path.join(jaspar_url, "api", "v1", "taxon", taxon)
-        response = client.get(url)
-        json_obj = json.loads(codec.encode(response))
 
-        # While there are more pages...
-        while json_obj["next"] is not None:
+        # For each page...
+        for json_obj in asyncio.run(__get_JASPAR_pages(url)):
 
             # For each profile...
             for profile in json_obj["results"]:
@@ -312,21 +403,69 @@ def __get_profile_info(taxon, out_dir=out_dir):
                 if profile["collection"] == "CORE":
                     profiles.setdefault(profile["matrix_id"], profile["name"])
 
-            # Go to next page
-            response = client.get(json_obj["next"])
-            json_obj = json.loads(codec.encode(response))
+        # Write
+        __write_JSON(profiles_json_file, profiles)
 
-        # Do last page
-        for profile in json_obj["results"]:
+async def __get_JASPAR_pages(url, page_size=1000):
+    """
+    Fetches all pages of a paginated JASPAR REST API endpoint concurrently.
+    """
 
-            # Add profiles from the CORE collection...
-                if profile["collection"] == "CORE":
-                    profiles.setdefault(profile["matrix_id"], profile["name"])
+    # Initialize
+    limits = httpx.Limits(max_connections=max_connections)
+    params = {"format": "json", "page_size": page_size}
+
+    async with httpx.AsyncClient(limits=limits, follow_redirects=True,
+        timeout=30) as client:
+
+        # Get first page (i.e. to know the number of pages)
+        response = await client.get(url, params={**params, "page": 1})
+        response.raise_for_status()
+        json_objs = [response.json()]
+        n_pages = math.ceil(json_objs[0]["count"] / page_size)
+
+        # Get remaining pages
+        responses = await asyncio.gather(*[
+            client.get(url, params={**params, "page": page})
+            for page in range(2, n_pages + 1)
+        ])
+        for response in responses:
+            response.raise_for_status()
+            json_objs.append(response.json())
+
+    return(json_objs)
+
+async def __get_JASPAR_matrices(profiles):
+    """
+    Fetches the detailed info of JASPAR profiles concurrently.
+    """
 
-        # Write
-        Jglobals.write(
-            profiles_json_file, json.dumps(profiles, sort_keys=True, indent=4)
-        )
+    # Initialize
+    limits = httpx.Limits(max_connections=max_connections)
+    semaphore = asyncio.Semaphore(max_connections)
+
+    async with httpx.AsyncClient(limits=limits, follow_redirects=True,
+        timeout=30) as client:
+
+        # Get profiles
+        json_objs = await asyncio.gather(*[
+            __get_JASPAR_matrix(profile, client, semaphore)
+            for profile in profiles
+        ])
+
+    return(json_objs)
+
+async def __get_JASPAR_matrix(profile, client, semaphore):
+
+    # Initialize
+    url = os.path.join(jaspar_url, "api", "v1", "matrix", profile)
+
+    # Get profile
+    async with semaphore:
+        response = await client.get(url, params={"format": "json"})
+        response.raise_for_status()
+
+    return(response.json())
 
 def __download_UniProt_sequences(taxon, out_dir=out_dir):
 
@@ -366,28 +505,21 @@ def __download_UniProt_sequences(taxon, out_dir=out_dir):
         ]
     }
 
-    # Change dir
-    os.chdir(out_dir)
-
     # Skip if pickle file already exists
-    pickle_file = ".%s.uniaccs.pickle" % taxon
+    pickle_file = os.path.join(out_dir, ".%s.uniaccs.pickle" % taxon)
     if not os.path.exists(pickle_file):
 
         # Initialize
         uniaccs = {}
 
         # Load JSON file
-        profiles_json_file = taxon + profiles_file_ext
+        profiles_json_file = os.path.join(out_dir, taxon + profiles_file_ext)
         with open(profiles_json_file) as f:
             profiles = json.load(f)
 
         # For each profile...
-        for profile in sorted(profiles):
-
-            # Get profile detailed info
-            url = os.path.join(jaspar_url, "api", "v1", "matrix", profile)
-            response = client.get(url)
-            json_obj = json.loads(codec.encode(response))
+        for profile, json_obj in zip(sorted(profiles),
+            asyncio.run(__get_JASPAR_matrices(sorted(profiles)))):
 
             # For each UniProt Accession...
             for uniacc in json_obj["uniprot_ids"]:
@@ -405,32 +537,104 @@ def __download_UniProt_sequences(taxon, out_dir=out_dir):
             pickle.dump(uniaccs, f)
 
     # Skip if taxon uniprot JSON file already exists
-    uniprot_json_file = taxon + uniprot_file_ext
+    uniprot_json_file = os.path.join(out_dir, taxon + uniprot_file_ext)
     if not os.path.exists(uniprot_json_file):
 
         # Load pickle file
         with open(pickle_file, "rb") as f:
             uniaccs = pickle.load(f)
 
-        # For each UniProt Accession...
-        for uniacc in uniaccs:
+        # Open UniProt cache (i.e. shared across taxons and runs)
+        with shelve.open(os.path.join(out_dir, uniprot_cache_file)) as cache:
 
-            # Fix faulty sequences
-            if uniacc in faulty_sequences:
-                uniaccs[uniacc][1] = "".join(faulty_sequences[uniacc]) 
-                continue
+            # Get UniProt sequences not in cache (i.e. concurrently)
+            uniaccs_to_fetch = [u for u in sorted(uniaccs)
+                if u not in faulty_sequences and u not in cache]
+            sequences = asyncio.run(__get_UniProt_sequences(uniaccs_to_fetch))
+            for uniacc, sequence in sequences.items():
+                cache[uniacc] = sequence
 
-            # Get UniProt sequence
-            u = uniprot.queryUniprot(uniacc)
-            uniaccs[uniacc][1] = "".join(u["sequence   0"].split("\n"))
+            # Add UniProt sequences
+            for uniacc in uniaccs:
+                if uniacc in cache:
+                    uniaccs[uniacc][1] = cache[uniacc]
+
+        # Fix faulty sequences
+        for uniacc in faulty_sequences:
+            if uniacc in uniaccs:
+                uniaccs[uniacc][1] = "".join(faulty_sequences[uniacc])
 
         # Write
-        Jglobals.write(
-            uniprot_json_file, json.dumps(uniaccs, sort_keys=True, indent=4)
-        )
+        __write_JSON(uniprot_json_file, uniaccs)
 
-    # Change dir
-    os.chdir(cwd)
+async def __get_UniProt_sequences(uniaccs, batch_size=200):
+    """
+    Fetches the sequences of UniProt Accessions in concurrent batches and
+    returns them as a {dict}.
+    """
+
+    # Initialize
+    sequences = {}
+    limits = httpx.Limits(max_connections=max_connections,
+        max_keepalive_connections=max_connections)
+    semaphore = asyncio.Semaphore(max_connections)
+    batches = [uniaccs[i:i + batch_size]
+        for i in range(0, len(uniaccs), batch_size)]
+
+    async with httpx.AsyncClient(limits=limits, follow_redirects=True,
+        timeout=300) as client:
+
+        # Get UniProt sequences in batches
+        for batch_sequences in await asyncio.gather(*[
+            __get_UniProt_batch(batch, client, semaphore) for batch in batches
+        ]):
+            sequences.update(batch_sequences)
+
+        # Get missing UniProt sequences one by one (e.g. secondary accessions
+        # are returned under the primary accession of their UniProt entry)
+        missing = [u for u in uniaccs if u not in sequences]
+        for uniacc, sequence in await asyncio.gather(*[
+            __get_UniProt_sequence(uniacc, client, semaphore)
+            for uniacc in missing
+        ]):
+            sequences.setdefault(uniacc, sequence)
+
+    return(sequences)
+
+async def __get_UniProt_batch(uniaccs, client, semaphore):
+
+    # Initialize
+    sequences = {}
+    url = "https://rest.uniprot.org/uniprotkb/stream"
+    query = " OR ".join(["accession:%s" % uniacc for uniacc in uniaccs])
+
+    # Get UniProt sequences
+    async with semaphore:
+        response = await client.get(url, params={"format": "fasta",
+            "query": query})
+        response.raise_for_status()
+
+    # For each SeqRecord...
+    for seq_record in SeqIO.parse(StringIO(response.text), "fasta"):
+
+        # i.e. >sp|P26632|EGR1_DANRE
+        uniacc = seq_record.id.split("|")[1]
+        if uniacc in uniaccs:
+            sequences.setdefault(uniacc, str(seq_record.seq))
+
+    return(sequences)
+
+async def __get_UniProt_sequence(uniacc, client, semaphore):
+
+    # Initialize
+    url = "https://rest.uniprot.org/uniprotkb/%s.fasta" % uniacc
+
+    # Get UniProt sequence
+    async with semaphore:
+        response = await client.get(url)
+        response.raise_for_status()
+
+    return(uniacc, "".join(response.text.split("\n")[1:]))
 
 def __format_BLAST_database(taxon, out_dir=out_dir):
 
@@ -439,7 +643,7 @@ def __format_BLAST_database(taxon, out_dir=out_dir):
     if not os.path.exists(fasta_file):
 
         # Load JSON file
-        uniprot_json_file = taxon + uniprot_file_ext
+        uniprot_json_file = os.path.join(out_dir, taxon + uniprot_file_ext)
         with open(uniprot_json_file) as f:
             uniaccs = json.load(f)
 
@@ -453,20 +657,16 @@ def __format_BLAST_database(taxon, out_dir=out_dir):
         process = subprocess.run(
             [cmd], shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-def __get_Pfam_alignments(taxon, out_dir=out_dir):
+def __get_Pfam_alignments(taxon, hmms, profiles, out_dir=out_dir, threads=1):
 
     # Skip if Pfam JSON file already exists
     pfam_json_file = os.path.join(out_dir, taxon + pfam_file_ext)
     if not os.path.exists(pfam_json_file):
 
-        # Change dir
-        os.chdir(out_dir)
-
         # Initialize
         pfams = {}
-        seq_file = ".seq.fasta"
-        hmm_db = os.path.join("pfam", "All.hmm")
-        uniprot_json_file = taxon + uniprot_file_ext
+        seq_records = {}
+        uniprot_json_file = os.path.join(out_dir, taxon + uniprot_file_ext)
 
         # Load JSON file
         with open(uniprot_json_file) as f:
@@ -478,38 +678,39 @@ def __get_Pfam_alignments(taxon, out_dir=out_dir):
             # Initialize
             pfams.setdefault(u, [])
 
-            # Make seq file
+            # Add SeqRecord
             seq = Seq(uniaccs[u][1], IUPAC.protein)
-            record = SeqRecord(seq, id=u, name=u, description=u)
-            __make_seq_file(record, seq_file)
+            seq_records.setdefault(u, SeqRecord(seq, id=u, name=u,
+                description=u))
 
-            # For each DBD...
-            for pfam_id_std, start, end, evalue in hmmscan(seq_file, hmm_db,
-                non_overlapping_domains=True):
-
-                # Initialize
-                hmm_file = os.path.join("pfam", "%s.hmm" % pfam_id_std)
+        # Group DBDs by Pfam ID
+        dbds = {}
+        for u, pfam_id_std, start, end, evalue in hmmsearch(
+            list(seq_records.values()), profiles, threads,
+            non_overlapping_domains=True):
+            dbds.setdefault(pfam_id_std, [])
+            dbds[pfam_id_std].append((u, start, end, evalue))
 
-                # Make seq file
-                sub_seq = seq[start:end]
-                record = SeqRecord(sub_seq, id=u, name=u, description=u)
-                __make_seq_file(record, seq_file)
+        # For each Pfam ID...
+        for pfam_id_std in sorted(dbds):
 
-                # Add DBDs
-                alignment = hmmalign(seq_file, hmm_file)
-                pfams[u].append((pfam_id_std, alignment, start+1, end, evalue))
+            # Initialize
+            records = [seq_records[u][start:end]
+                for u, start, end, _ in dbds[pfam_id_std]]
 
-        # Write
-        Jglobals.write(
-            pfam_json_file, json.dumps(pfams, sort_keys=True, indent=4)
-        )
+            # Add DBDs
+            alignments = hmmalign(records, hmms[pfam_id_std])
+            for i in range(len(records)):
+                u, start, end, evalue = dbds[pfam_id_std][i]
+                pfams[u].append((pfam_id_std, alignments[i], start+1, end,
+                    evalue))
 
-        # Remove seq file
-        if os.path.exists(seq_file):
-            os.remove(seq_file)
+        # Sort DBDs by start
+        for u in pfams:
+            pfams[u].sort(key=lambda x: x[2])
 
-        # Change dir
-        os.chdir(cwd)
+        # Write
+        __write_JSON(pfam_json_file, pfams)
 
 #-------------#
 # Main        #
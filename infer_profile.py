@@ -1,8 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
-from Bio import SearchIO
-from Bio.SeqRecord import SeqRecord
+import bisect
 from Bio.SubsMat.MatrixInfo import blosum62
 import copy
 from functools import partial
@@ -11,7 +10,7 @@ import math
 from multiprocessing import Pool
 import numpy as np
 import os
-import re
+import pyhmmer
 import shutil
 import string
 import subprocess
@@ -96,8 +95,8 @@ def infer_profiles(fasta_file, dummy_dir="/tmp/", files_dir=files_dir,
 
     # Load data
     cisbp = __load_CisBP_models(files_dir)
-    # jaspar = __load_JASPAR_files_n_models(files_dir, models_dir, taxons)
     jaspar = __load_JASPAR_files_n_models(files_dir, taxons)
+    hmm_file = os.path.join(files_dir, "pfam", "All.hmm")
 
     # Create dummy dir
     dummy_dir = os.path.join(dummy_dir, "%s.%s" % (base_name, pid))
@@ -120,9 +119,11 @@ def infer_profiles(fasta_file, dummy_dir="/tmp/", files_dir=files_dir,
 
     # Infer SeqRecord profiles
     kwargs = {"total": len(seq_records), "bar_format": bar_format}
-    pool = Pool(min([threads, len(seq_records)]))
-    p = partial(infer_SeqRecord_profiles, cisbp=cisbp, dummy_dir=dummy_dir,
-        files_dir=files_dir, jaspar=jaspar, latest=latest, n=n, taxons=taxons)
+    # i.e. Pfam DBD HMMs are loaded once per worker (not per sequence)
+    pool = Pool(min([threads, len(seq_records)]),
+        initializer=__load_Pfam_HMMs_n_profiles, initargs=(hmm_file,))
+    p = partial(infer_SeqRecord_profiles, cisbp=cisbp, files_dir=files_dir,
+        jaspar=jaspar, latest=latest, n=n, taxons=taxons)
     for inferences in tqdm(pool.imap(p, seq_records), **kwargs):
         for inference in inferences:
             Jglobals.write(dummy_file, "\t".join(map(str, inference)))
@@ -185,17 +186,16 @@ def __load_JASPAR_files_n_models(files_dir="./files/", taxons=["fungi",
 
     return(jaspar)
 
-def infer_SeqRecord_profiles(seq_record, cisbp, jaspar, dummy_dir="/tmp/",
-    files_dir="./files/", latest=False, n=5, taxons=["fungi", "insects",
-    "nematodes", "plants", "vertebrates"]):
+def infer_SeqRecord_profiles(seq_record, cisbp, jaspar, files_dir="./files/",
+    latest=False, n=5, taxons=["fungi", "insects", "nematodes", "plants",
+    "vertebrates"]):
 
     # Initialize
     pfam_alignments = []
     inference_results = []
 
     # Get SeqRecord Pfam DBDs
-    alignments = __get_SeqRecord_Pfam_alignments(seq_record,
-        files_dir, dummy_dir)
+    alignments = __get_SeqRecord_Pfam_alignments(seq_record, files_dir)
     if len(alignments) == 0:
         return(inference_results)
     pfam_alignments.append({})
@@ -263,72 +263,153 @@ def infer_SeqRecord_profiles(seq_record, cisbp, jaspar, dummy_dir="/tmp/",
 
     return(inference_results)
 
-def __get_SeqRecord_Pfam_alignments(seq_record, files_dir="./files/",
-    dummy_dir="/tmp/"):
+def __load_Pfam_HMMs_n_profiles(hmm_file):
+    """
+    Loads the Pfam DBD HMMs and their optimized profiles into globals (i.e.
+    once per worker process of the pool, as optimized profiles cannot be
+    pickled).
+    """
+    global hmms, profiles
+    hmms = load_hmms(hmm_file)
+    profiles = load_profiles(hmm_file)
+
+def __get_SeqRecord_Pfam_alignments(seq_record, files_dir="./files/"):
 
     # Initialize
     pfam_alignments = []
-    hmm_db = os.path.join(files_dir, "pfam", "All.hmm")
 
-    # Make seq file
-    seq_file = os.path.join(dummy_dir, ".%s.seq.fasta" % os.getpid())
-    __make_seq_file(seq_record, seq_file)
+    # Load Pfam DBD HMMs
+    try:
+        hmms, profiles
+    except NameError:
+        __load_Pfam_HMMs_n_profiles(os.path.join(files_dir, "pfam", "All.hmm"))
 
     # For each DBD...
-    for pfam_id_std, start, end, evalue in hmmscan(seq_file, hmm_db, dummy_dir,
+    for _, pfam_id_std, start, end, evalue in hmmscan([seq_record], profiles,
         non_overlapping_domains=True):
 
-        # Initialize
-        hmm_file = os.path.join(files_dir, "pfam", "%s.hmm" % pfam_id_std)
-
-        # Make seq file
-        sub_seq_record = SeqRecord(seq_record.seq[start:end], id=seq_record.id,
-            name=seq_record.name, description=seq_record.description)
-        __make_seq_file(sub_seq_record, seq_file)
-
         # Add DBDs
-        alignment = hmmalign(seq_file, hmm_file)
+        alignment = hmmalign([seq_record[start:end]], hmms[pfam_id_std])[0]
         pfam_alignments.append((pfam_id_std, alignment, start+1, end, evalue))
 
     return(pfam_alignments)
 
-def __make_seq_file(seq_record, file_name=".seq.fa"):
+def load_hmms(hmm_file):
+    """
+    Loads the HMMs of a HMMER3 file into memory and returns them as a {dict}
+    keyed by HMM name.
+    """
+
+    with pyhmmer.plan7.HMMFile(hmm_file) as f:
+        return({hmm.name.decode(): hmm for hmm in f})
 
-    # Remove seq file if exists...
-    if os.path.exists(file_name):
-        os.remove(file_name)
+def load_profiles(hmm_file):
+    """
+    Loads the HMMs of a HMMER3 file into memory as optimized profiles (i.e.
+    ready to scan). If the file has been pressed with hmmpress, the profiles
+    are read from the binary database rather than parsed and configured.
+    """
 
-    # Write
-    Jglobals.write(file_name, seq_record.format("fasta"))
+    # Initialize
+    alphabet = pyhmmer.easel.Alphabet.amino()
+
+    with pyhmmer.plan7.HMMFile(hmm_file) as f:
+        if f.is_pressed():
+            return(pyhmmer.plan7.OptimizedProfileBlock(alphabet,
+                f.optimized_profiles()))
+
+    return(optimize_hmms(load_hmms(hmm_file)))
+
+def optimize_hmms(hmms):
+    """
+    Converts HMMs into an {OptimizedProfileBlock} that can be reused across
+    scans.
+    """
+
+    # Initialize
+    alphabet = pyhmmer.easel.Alphabet.amino()
+    background = pyhmmer.plan7.Background(alphabet)
+    profiles = pyhmmer.plan7.OptimizedProfileBlock(alphabet)
+
+    # For each HMM...
+    for hmm in hmms.values():
+        profile = pyhmmer.plan7.Profile(hmm.M, alphabet)
+        profile.configure(hmm, background)
+        profiles.append(profile.to_optimized())
+
+    return(profiles)
+
+def __digitize(seq_record):
+
+    # Initialize
+    alphabet = pyhmmer.easel.Alphabet.amino()
+    text_seq = pyhmmer.easel.TextSequence(name=seq_record.id.encode(),
+        sequence=str(seq_record.seq))
+
+    return(text_seq.digitize(alphabet))
+
+def hmmscan(seq_records, profiles, threads=1, non_overlapping_domains=False):
+
+    # Initialize
+    sequences = [__digitize(seq_record) for seq_record in seq_records]
+
+    # Scan (i.e. top hits are returned in the same order as sequences)
+    top_hits = pyhmmer.hmmer.hmmscan(sequences, profiles, cpus=threads)
+
+    # For each sequence...
+    for seq_record, hits in zip(seq_records, top_hits):
+
+        # Read domains
+        domains = __read_domains(hits)
+
+        # Filter overlapping domains
+        if non_overlapping_domains:
+            domains = __get_non_overlapping_domains(domains)
+
+        # Yield domains one by one
+        for pfam_ac, start, end, evalue in sorted(domains, key=lambda x: x[1]):
+
+            yield(seq_record.id, pfam_ac, start, end, evalue)
 
-def hmmscan(seq_file, hmm_file, dummy_dir="/tmp/",
-    non_overlapping_domains=False):
+def hmmsearch(seq_records, profiles, threads=1, non_overlapping_domains=False):
+    """
+    Same as hmmscan, but searching the profiles against the sequences rather
+    than scanning the sequences against the profiles (i.e. faster for many
+    sequences). E-values are computed as in hmmscan.
+    """
 
     # Initialize
-    out_file = os.path.join(dummy_dir, ".%s.out.txt" % os.getpid())
+    hits = {seq_record.id: [] for seq_record in seq_records}
+    alphabet = pyhmmer.easel.Alphabet.amino()
+    sequences = pyhmmer.easel.DigitalSequenceBlock(alphabet,
+        [__digitize(seq_record) for seq_record in seq_records])
 
-    # Scan
-    cmd = "hmmscan --domtblout %s %s %s" % (out_file, hmm_file, seq_file)
-    process = subprocess.run([cmd], shell=True, stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL)
+    # Search (i.e. with as many targets as profiles, as in hmmscan)
+    for top_hits in pyhmmer.hmmer.hmmsearch(profiles, sequences, cpus=threads,
+        Z=len(profiles)):
 
-    # Read domains
-    domains = __read_domains(out_file)
+        # Group hits by sequence
+        for hit in top_hits:
+            hits[hit.name.decode()].append(hit)
 
-    # Remove output file
-    if os.path.exists(out_file):
-        os.remove(out_file)
+    # For each sequence...
+    for seq_record in seq_records:
 
-    # Filter overlapping domains
-    if non_overlapping_domains:
-        domains = __get_non_overlapping_domains(domains)
+        # Read domains (i.e. the number of reported profiles is the
+        # effective search space for domains, as in hmmscan)
+        domZ = len([hit for hit in hits[seq_record.id] if hit.reported])
+        domains = __read_domains(hits[seq_record.id], domZ)
 
-    # Yield domains one by one
-    for pfam_ac, start, end, evalue in sorted(domains, key=lambda x: x[1]):
+        # Filter overlapping domains
+        if non_overlapping_domains:
+            domains = __get_non_overlapping_domains(domains)
 
-        yield(pfam_ac, start, end, evalue)
+        # Yield domains one by one
+        for pfam_ac, start, end, evalue in sorted(domains, key=lambda x: x[1]):
 
-def __read_domains(file_name):
+            yield(seq_record.id, pfam_ac, start, end, evalue)
+
+def __read_domains(hits, domZ=None):
     """
     From PMID:22942020;
     A hit has equal probability of being in the same clan as a different clan
@@ -341,6 +422,10 @@ def __read_domains(file_name):
     Hughes, 2011) and the HMMER tool (Eddy, 2009), with the recommended de-
     tection thresholds of Per-sequence Eval < 0.01 and Per-domain conditional
     Eval < 0.01.
+
+    Note that E-values are rounded to two significant digits, as they were
+    when read from the "--domtblout" output of hmmscan. If "domZ" is given,
+    conditional E-values are recomputed for that effective search space.
     """
 
     # Initialize
@@ -348,26 +433,28 @@ def __read_domains(file_name):
     cutoff_mod = 1e-5
     cutoff_dom = 0.01
 
-    # For each result...
-    for res in SearchIO.parse(file_name, "hmmscan3-domtab"):
-
-        # For each model...
-        for mod in res.iterhits():
+    # For each model...
+    for mod in hits:
 
-            # Skip poor models
-            if mod.evalue > cutoff_mod:
-                continue
+        # Skip poor models
+        if float("%.2g" % mod.evalue) > cutoff_mod:
+            continue
 
-            # For each domain...
-            for dom in mod.hsps:
+        # For each domain...
+        for dom in mod.domains:
 
-                # Skip poor domains
-                if dom.evalue_cond > cutoff_dom:
-                    continue
+            # Skip poor domains
+            if domZ is None:
+                evalue_cond = float("%.2g" % dom.c_evalue)
+            else:
+                evalue_cond = float("%.2g" % (dom.pvalue * domZ))
+            if evalue_cond > cutoff_dom:
+                continue
 
-                # Append domain
-                domains.append((mod.id, dom.query_start, dom.query_end,
-                    dom.evalue_cond))
+            # Append domain
+            domains.append((dom.alignment.hmm_name.decode(),
+                dom.alignment.target_from - 1, dom.alignment.target_to,
+                evalue_cond))
 
     return(domains)
 
@@ -384,48 +471,44 @@ def __get_non_overlapping_domains(domains):
 
     # Initialize
     nov_domains = []
+    starts = []
 
     # Sort domains by e-value
     for domain in sorted(domains, key=lambda x: x[-1]):
 
-        # Initialize
-        domains_overlap = False
-
-        # For each non-overlapping domain...
-        for nov_domain in nov_domains:
-
-            if domain[1] < nov_domain[2] and domain[2] > nov_domain[1]:
-                domains_overlap = True
-                break
+        # Non-overlapping domains are kept sorted by start (and thus by end):
+        # only the domains right before and after can overlap
+        i = bisect.bisect_right(starts, domain[1])
+        if i > 0 and domain[1] < nov_domains[i - 1][2]:
+            continue
+        if i < len(nov_domains) and domain[2] > nov_domains[i][1]:
+            continue
 
         # Add non-overlapping domain
-        if not domains_overlap:
-            nov_domains.append(domain)
+        starts.insert(i, domain[1])
+        nov_domains.insert(i, domain)
 
     return(nov_domains)
 
-def hmmalign(seq_file, hmm_file):
-
-    # Align
-    cmd = "hmmalign --outformat PSIBLAST %s %s" % (hmm_file, seq_file)
-    process = subprocess.check_output([cmd], shell=True, universal_newlines=True)
-
-    return(__read_PSIBLAST_format(process))
-
-def __read_PSIBLAST_format(psiblast_alignment):
+def hmmalign(seq_records, hmm):
+    """
+    Aligns one or more sequences to a HMM and returns their alignments as in
+    the PSI-BLAST output format of hmmalign (i.e. insertions in lower case).
+    """
 
     # Initialize
-    alignment = ""
+    alphabet = pyhmmer.easel.Alphabet.amino()
+    sequences = pyhmmer.easel.DigitalSequenceBlock(alphabet,
+        [__digitize(seq_record) for seq_record in seq_records])
+    aligner = pyhmmer.plan7.TraceAligner()
 
-    # For each chunk...
-    for chunk in psiblast_alignment.split("\n"):
-
-        # If alignment substring...
-        m = re.search("\s+(\S+)$", chunk)
-        if m:
-            alignment += m.group(1)
+    # Align
+    traces = aligner.compute_traces(hmm, sequences)
+    msa = aligner.align_traces(hmm, sequences, traces, all_consensus_cols=True)
 
-    return(alignment)
+    # Remove gaps in insert columns (i.e. from the insertions of other
+    # sequences) so that each alignment is that of the sequence on its own
+    return([alignment.replace(".", "") for alignment in msa.alignment])
 
 def blast(seq_record, files_dir="./files/", taxons=["fungi", "insects",
     "nematodes", "plants", "vertebrates"], n=5):
@@ -528,20 +611,6 @@ def __get_Rost_cutoff_percent_identity(L, n=5):
     """
     return(n + (480 * pow(L, -0.32 * (1 + pow(math.e, float(-L) / 1000)))))
 
-# def __is_alignment_over_Rost_seq_sim_curve(psim, L, n=12):
-#     """
-#     This function returns whether an alignment is over the Rost's pairwise
-#     sequence similarity curve or not.
-#     """
-#     return(psim >= _get_Rost_cutoff_percent_similarity(L, n))
-
-# def __get_Rost_cutoff_percent_similarity(L, n=12):
-#     """
-#     This function returns the Rost's cut-off percentage of "similar" residues
-#     for an alignment of length "L".
-#     """
-#     return(n + (420 * pow(L, -0.335 * (1 + pow(math.e, float(-L) / 2000)))))
-
 def __get_blast_results_Pfam_alignments(blast_results, jaspar):
 
     # Initialize
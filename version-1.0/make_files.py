@@ -15,6 +15,12 @@ import functions
 # Globals
 taxons = ["fungi", "insects", "nematodes", "plants", "vertebrates"]
 
+# Regular expressions (i.e. for Cis-BP SQL dumps)
+prot_feature_re = re.compile(r"\('.+', '(.+)', '.+', \d+, \d+, '(.+)'\)")
+tf_re = re.compile(r"\('(.+)', '(.+)', '.+', '.+', '.+', '.+', '.+'\)")
+tf_family_re = re.compile(r"\('(.+)', '.+', '.+', \d+, (.+)\)")
+protein_re = re.compile(r"\('(.+)', '(.+)', '.+', '.+', '([A-Z]+)\W*'\)")
+
 #-------------#
 # Functions   #
 #-------------#
@@ -145,12 +151,17 @@ def make_files(out_dir=os.path.dirname(os.path.realpath(__file__))):
                     ">%s\n%s" % (uniacc, uniaccs[uniacc][1]))
             # Create BLAST+ db
             try:
-                process = subprocess.check_output([
+                process = subprocess.run([
                     "makeblastdb",
                     "-in", fasta_file,
                     "-dbtype", "prot"],
-                    stderr=subprocess.STDOUT)
-            except:
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    check=True)
+            except subprocess.CalledProcessError as e:
+                raise ValueError("Could not create BLAST+ database: %s\n%s" % (
+                    fasta_file, e.stderr.decode()))
+            except OSError:
                 raise ValueError("Could not create BLAST+ database: %s" % fasta_file)
 
     # Skip if Cis-BP JSON file already exists
@@ -188,7 +199,7 @@ def make_files(out_dir=os.path.dirname(os.path.realpath(__file__))):
         with open(os.path.join(cisbp_dir, "cisbp_1.02.prot_features.sql")) as f:
             # For each line...
             for line in f:
-                m = re.search("\('.+', '(.+)', '.+', \d+, \d+, '(.+)'\)", line)
+                m = prot_feature_re.search(line)
                 if m:
                     prot_features.setdefault(m.group(1), set())
                     prot_features[m.group(1)].add(m.group(2))
@@ -196,21 +207,21 @@ def make_files(out_dir=os.path.dirname(os.path.realpath(__file__))):
         with open(os.path.join(cisbp_dir, "cisbp_1.02.tfs.sql")) as f:
             # For each line...
             for line in f:
-                m = re.search("\('(.+)', '(.+)', '.+', '.+', '.+', '.+', '.+'\)", line)
+                m = tf_re.search(line)
                 if m:
                     tfs.setdefault(m.group(1), m.group(2))
         # Get TF families
         with open(os.path.join(cisbp_dir, "cisbp_1.02.tf_families.sql")) as f:
             # For each line...
             for line in f:
-                m = re.search("\('(.+)', '.+', '.+', \d+, (.+)\)", line)
+                m = tf_family_re.search(line)
                 if m:
                     tf_families.setdefault(m.group(1), m.group(2))
         # Get proteins
         with open(os.path.join(cisbp_dir, "cisbp_1.02.proteins.sql")) as f:
             # For each line...
             for line in f:
-                m = re.search("\('(.+)', '(.+)', '.+', '.+', '([A-Z]+)\W*'\)", line)
+                m = protein_re.search(line)
                 if m:
                     if m.group(1) not in prot_features: continue
                     # Digest to MD5
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """
 tool:    jaspartools infer (i.e. profile_inferrer.py)
@@ -13,22 +13,49 @@ usage:   jaspartools infer [-h] [--dummy] [-n] [-o] [--threads]
                            [--plants] [--vertebrates] [-l] fasta
 """
 
-import os, re
+import os
 import argparse
 from Bio import pairwise2
 from Bio import SeqIO
-from Bio.SubsMat.MatrixInfo import blosum62
-from functools import partial
+from Bio.Align import substitution_matrices
+from functools import lru_cache, partial
+from io import BytesIO
 import json
-import math
 from multiprocessing import Pool
+import numpy
+import pandas
 import shutil
 import subprocess
 from tqdm import tqdm
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+try:
+    import parasail
+except ImportError:
+    parasail = None
 
 # Import my functions
 import functions
 
+# Globals
+blosum62 = substitution_matrices.load("BLOSUM62")
+if parasail is not None:
+    # BLOSUM62 for parasail: scores are doubled (i.e. parasail requires integer
+    # gap penalties) and weighted by 4,096 plus one per identity, so that ties
+    # between optimal alignments are broken in favor of the most identities
+    # (i.e. as pairwise2 returns all optimal alignments; DBDs < 4,096 aa)
+    parasail_blosum62 = parasail.blosum62.copy()
+    for i in range(parasail_blosum62.size):
+        for j in range(parasail_blosum62.size):
+            parasail_blosum62.set_value(i, j,
+                4096 * 2 * parasail.blosum62.matrix[i, j] + (i == j))
+# Rost sequence identity thresholds (i.e. w/o "n") indexed by alignment length
+_ROST_LENGTHS = numpy.arange(1, 65536)
+Rost_ID_thresholds = numpy.concatenate(([numpy.inf], 480 * numpy.power(
+    _ROST_LENGTHS, -0.32 * (1 + numpy.exp(-_ROST_LENGTHS / 1000)))))
+
 #-------------#
 # Functions   #
 #-------------#
@@ -109,37 +136,59 @@ def infer_profiles(fasta_file, files_dir, dummy_dir="/tmp/", latest=False, n=5,
     # Get sequences as SeqRecords
     # Note: https://biopython.org/wiki/SeqRecord
     seq_records = []
-    for seq_record in SeqIO.parse(fasta_file, "fasta"):
-        seq_records.append(seq_record)
+    with open(fasta_file, buffering=1 << 22) as handle:
+        for seq_record in SeqIO.parse(handle, "fasta"):
+            seq_records.append(seq_record)
 
     # Load JSON files
-    global domains, jaspar
-    domains, jaspar = _load_json_files(files_dir)
-
-    # Write
-    functions.write(dummy_file,
-        "Query\tTF Name\tTF Matrix\tE-value\tQuery Start-End\tTF Start-End\tDBD %ID")
-    # Infer SeqRecord profiles
-    pool = Pool(threads)
-    parallelization = partial(infer_SeqRecord_profiles, files_dir=files_dir,
-        dummy_dir=dummy_dir, latest=latest, n=n, taxons=taxons)
-    for inference_results in tqdm(pool.imap(parallelization, iter(seq_records)),
-        desc="Profile inference", total=len(seq_records)):
-        # Sort by E-value, TF Name and Matrix
-        if latest:
-            inference_results.sort(key=lambda x: (x[3], x[1], -float(x[2][2:])))
-        else:
-            inference_results.sort(key=lambda x: (x[3], x[1], float(x[2][2:])))
-        # For each inference...
-        for i in range(len(inference_results)):
-            # Use the lastest version of JASPAR
-            if latest and i > 0:
-                if inference_results[i][2][:6] == inference_results[i - 1][2][:6]:
-                    continue
-            # Write
-            functions.write(dummy_file, "\t".join(map(str, inference_results[i])))
-    pool.close()
-    pool.join()
+    global targets
+    targets = _load_json_files(files_dir)
+
+    # Homology search (i.e. all sequences at once)
+    homologs = _homology_search(seq_records, files_dir, n, taxons, threads)
+
+    # Open dummy file (i.e. once, w/ a 1 MB write buffer)
+    with open(dummy_file, "w", buffering=1 << 20) as out_file:
+        # Write
+        out_file.write(
+            "Query\tTF Name\tTF Matrix\tE-value\tQuery Start-End\tTF Start-End\tDBD %ID\n")
+        # Infer SeqRecord profiles
+        # i.e. JSON files are passed once per worker, and each sequence is passed
+        # along w/ its homologs
+        pool = Pool(threads, initializer=_initialize_worker, initargs=(targets,))
+        parallelization = partial(_infer_SeqRecord_profiles_from_homologs,
+            files_dir=files_dir, dummy_dir=dummy_dir, latest=latest, n=n,
+            taxons=taxons)
+        chunksize = max(1, len(seq_records) // (threads * 4))
+        for inference_results in tqdm(pool.imap(parallelization,
+            zip(seq_records, homologs), chunksize), desc="Profile inference",
+            total=len(seq_records)):
+            # Sort by E-value, TF Name and Matrix
+            if latest:
+                inference_results.sort(key=lambda x: (x[3], x[1], -float(x[2][2:])))
+            else:
+                inference_results.sort(key=lambda x: (x[3], x[1], float(x[2][2:])))
+            # Initialize
+            inferred_profiles = set()
+            latest_versions = {}
+            # Get the lastest version of each JASPAR profile
+            if latest:
+                for inference in inference_results:
+                    version = int(inference[2].split(".")[1])
+                    if version > latest_versions.get(inference[2][:6], 0):
+                        latest_versions[inference[2][:6]] = version
+            # For each inference...
+            for inference in inference_results:
+                # Use the lastest version of JASPAR (i.e. once per profile)
+                if latest:
+                    if inference[2][:6] in inferred_profiles: continue
+                    if int(inference[2].split(".")[1]) < latest_versions[inference[2][:6]]:
+                        continue
+                    inferred_profiles.add(inference[2][:6])
+                # Write
+                out_file.write("\t".join(map(str, inference)) + "\n")
+        pool.close()
+        pool.join()
 
     # Write
     if output_file:
@@ -153,31 +202,63 @@ def infer_profiles(fasta_file, files_dir, dummy_dir="/tmp/", latest=False, n=5,
     # Remove dummy dir
     shutil.rmtree(dummy_dir)
 
+def _initialize_worker(worker_targets):
+    """
+    This function initializes the globals of a worker process of the pool.
+    """
+    global targets
+    targets = worker_targets
+
 def _load_json_files(files_dir):
+    """
+    This function loads the DBDs and JASPAR matrices of each TF, and returns
+    them indexed by UniProt Accession as (DBDs, DBD %ID threshold, matrices).
+    """
 
     with open(os.path.join(files_dir, "domains.json")) as f:
         domains = json.load(f)
     with open(os.path.join(files_dir, "jaspar.json")) as f:
         jaspar = json.load(f)
 
-    return domains, jaspar
+    # Convert DBD %ID thresholds to float (i.e. once rather than per alignment)
+    return {uniacc: (domains[uniacc][0], float(domains[uniacc][1]), jaspar[uniacc])
+        for uniacc in domains if uniacc in jaspar}
+
+def _infer_SeqRecord_profiles_from_homologs(seq_record_n_homologs, **kwargs):
+    """
+    This function infers the profiles of a sequence from its homologs (i.e. as
+    returned by the homology search of all sequences at once).
+    """
+    (seq_record, homology_search_results) = seq_record_n_homologs
+
+    return infer_SeqRecord_profiles(seq_record,
+        homology_search_results=homology_search_results, **kwargs)
 
 def infer_SeqRecord_profiles(seq_record, files_dir, dummy_dir="/tmp/", latest=False,
-    n=5, taxons=["fungi", "insects", "nematodes", "plants", "vertebrates"]):
+    n=5, taxons=["fungi", "insects", "nematodes", "plants", "vertebrates"],
+    homology_search_results=None):
 
     # Initialize
     inference_results = []
 
     # Homology search
-    homology_search_results = _SeqRecord_homology_search(seq_record, files_dir,
-        dummy_dir, n, taxons)
+    if homology_search_results is None:
+        homology_search_results = _SeqRecord_homology_search(seq_record,
+            files_dir, n, taxons)
+
+    # Initialize
+    profile_inference_results = {}
 
     # For each result...
     for result in homology_search_results:
         # Initialize
         (query, target, query_start_end, target_start_end, e_value, score) = result
+        # Infer profiles (i.e. once per target, as the full query is aligned)
+        if target not in profile_inference_results:
+            profile_inference_results[target] = _SeqRecord_profile_inference(
+                seq_record, target, files_dir)
         # For each result...
-        for result in _SeqRecord_profile_inference(seq_record, target, files_dir):
+        for result in profile_inference_results[target]:
             # Initialize
             (gene_name, matrix, identities) = result
             # Add result
@@ -186,11 +267,25 @@ def infer_SeqRecord_profiles(seq_record, files_dir, dummy_dir="/tmp/", latest=Fa
 
     return inference_results
 
-def _SeqRecord_homology_search(seq_record, files_dir, dummy_dir="/tmp/", n=5,
+def _SeqRecord_homology_search(seq_record, files_dir, n=5,
     taxons=["fungi", "insects", "nematodes", "plants", "vertebrates"]):
 
+    return _homology_search([seq_record], files_dir, n, taxons)[0]
+
+def _homology_search(seq_records, files_dir, n=5,
+    taxons=["fungi", "insects", "nematodes", "plants", "vertebrates"], threads=1):
+    """
+    This function searches all sequences against the JASPAR TFs of each taxon
+    in a single BLAST+ run, and returns their homologs in the same order as the
+    sequences.
+    """
+
     # Initialize
-    search_results = set()
+    # i.e. sequences are identified by index, as identifiers can be duplicated
+    # or reformatted by BLAST+
+    search_results = [set() for seq_record in seq_records]
+    fasta_sequences = "\n".join([">q%s\n%s" % (i, seq_record.seq)
+        for i, seq_record in enumerate(seq_records)])
 
     # For each taxon...
     for taxon in taxons:
@@ -198,63 +293,70 @@ def _SeqRecord_homology_search(seq_record, files_dir, dummy_dir="/tmp/", n=5,
         taxon_db = os.path.join(files_dir, "%s.fa" % taxon)
         # Homology search
         try:
-            process = subprocess.Popen([
+            process = subprocess.run([
                 "blastp",
                 "-db", taxon_db,
-                "-outfmt", "6"],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE)
-            fasta_sequence = ">%s\n%s" % (seq_record.id, seq_record.seq)
-            process.stdin.write(fasta_sequence.encode())
-            (blast_records, blast_errors) = process.communicate()
-            # For each BLAST+ record...
-            for blast_record in blast_records.decode("utf-8").split("\n"):
-                # A BLAST+ record is formatted as a tab-separated list w/ 12 columns:
-                # (1,2) identifiers for query and target sequences;
-                # (3) percentage sequence identity
-                # (4) alignment length;
-                # (5) number of mismatches;
-                # (6) number of gap openings;
-                # (7-8, 9-10) start and end-position in query and in target;
-                # (11) E-value; and
-                # (12) bit score.
-                blast_record = blast_record.split("\t")
-                # Skip if not a BLAST+ record
-                if len(blast_record) != 12: continue
-                # Initialize
-                target = blast_record[1]
-                perc_identity = float(blast_record[2])
-                alignment_length = int(blast_record[3])
-                query_start_end = "%s-%s" % (blast_record[6], blast_record[7])
-                target_start_end = "%s-%s" % (blast_record[8], blast_record[9])
-                e_value = float(blast_record[10])
-                score = float(blast_record[11])
-                # If homologs...
-                if _is_alignment_over_Rost_sequence_identity_curve(
-                    round(alignment_length * perc_identity/100), alignment_length, n):
-                    # Add homolog to search results
-                    search_results.add((seq_record.id, target, query_start_end,
-                        target_start_end, e_value, score))
-        except:
+                "-outfmt", "6",
+                "-num_threads", str(threads)],
+                input=fasta_sequences.encode(),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=True)
+        except subprocess.CalledProcessError as e:
+            raise ValueError("Could not exec BLAST+!\n%s" % e.stderr.decode())
+        except OSError:
             raise ValueError("Could not exec BLAST+!")
+        blast_records = process.stdout
+        # Skip if no BLAST+ records
+        if not blast_records.strip(): continue
+        # A BLAST+ record is formatted as a tab-separated list w/ 12 columns:
+        # (1,2) identifiers for query and target sequences;
+        # (3) percentage sequence identity
+        # (4) alignment length;
+        # (5) number of mismatches;
+        # (6) number of gap openings;
+        # (7-8, 9-10) start and end-position in query and in target;
+        # (11) E-value; and
+        # (12) bit score.
+        blast_records = pandas.read_csv(BytesIO(blast_records), sep="\t",
+            header=None, names=["query", "target", "perc_identity",
+            "alignment_length", "mismatches", "gap_openings", "query_start",
+            "query_end", "target_start", "target_end", "e_value", "score"],
+            usecols=["query", "target", "perc_identity", "alignment_length",
+            "query_start", "query_end", "target_start", "target_end", "e_value",
+            "score"], dtype={"query": str, "target": str},
+            float_precision="round_trip")
+        # Get homologs (i.e. alignments over the Rost's curve)
+        identities = numpy.round(blast_records["alignment_length"] *\
+            blast_records["perc_identity"] / 100)
+        blast_records = blast_records[identities >= _get_Rost_ID_thresholds(
+            blast_records["alignment_length"].to_numpy(), n)]
+        # For each homolog...
+        for homolog in blast_records.itertuples(index=False):
+            # Add homolog to search results
+            i = int(homolog.query[1:])
+            search_results[i].add((seq_records[i].id, homolog.target,
+                "%s-%s" % (homolog.query_start, homolog.query_end),
+                "%s-%s" % (homolog.target_start, homolog.target_end),
+                homolog.e_value, homolog.score))
 
     # Return results sorted by score
-    return list(sorted(search_results, key=lambda x: x[-1], reverse=True))
+    return [sorted(homologs, key=lambda x: x[-1], reverse=True)
+        for homologs in search_results]
 
-def _is_alignment_over_Rost_sequence_identity_curve(identities, alignment_length, n=5):
+def _get_Rost_ID_thresholds(L, n=5):
     """
-    This function evaluates whether an alignment is over the Rost's sequence identity
-    curve or not.
+    This function returns the Rost sequence identity thresholds for alignments of
+    lengths "L" (i.e. an array). Alignments longer than the precomputed thresholds
+    are computed from the Rost's curve.
     """
-    return identities >= _get_Rost_ID_threshold(alignment_length, n)
-
-def _get_Rost_ID_threshold(L, n=5):
-    """
-    This function returns the Rost sequence identity threshold for a given alignment of
-    length "L".
-    """    
-    return n + (480 * pow( L, float('-0.32') *\
-        (1 + pow(float(repr(math.e)), float(repr(float(-L) / 1000))))))
+    thresholds = Rost_ID_thresholds[numpy.minimum(L, len(Rost_ID_thresholds) - 1)]
+    # For each alignment longer than the precomputed thresholds...
+    is_long = L >= len(Rost_ID_thresholds)
+    if is_long.any():
+        thresholds[is_long] = 480 * numpy.power(L[is_long],
+            -0.32 * (1 + numpy.exp(-L[is_long] / 1000)))
+    return n + thresholds
 
 def _SeqRecord_profile_inference(seq_record, uniacc, files_dir):
 
@@ -262,53 +364,101 @@ def _SeqRecord_profile_inference(seq_record, uniacc, files_dir):
     inference_results = {}
 
     # Load JSON files
-    global domains, jaspar
+    global targets
     try:
-        domains, jaspar
+        targets
     except NameError:
-        domains, jaspar = _load_json_files(files_dir)
+        targets = _load_json_files(files_dir)
 
     # If domains...
-    if uniacc in domains:
+    if uniacc in targets:
+        # Initialize
+        sequence = str(seq_record.seq)
+        (uniacc_domains, threshold, matrices) = targets[uniacc]
+        profile = None
+        if parasail is not None:
+            profile = _get_parasail_profile(sequence)
+        max_identities = None
         # For each domain...
-        for domain in domains[uniacc][0]:
+        for domain in uniacc_domains:
             # For each pairwise alignment...
-            for alignment in _pairwise_alignment(
-                seq_record.seq, domain):
-                # If alignment does not satisfy the threshold...
+            for alignment in _pairwise_alignment(sequence, domain, profile):
+                # If alignment satisfies the threshold...
                 identities = _get_alignment_identities(
                     alignment[0], alignment[1]) / float(len(domain))
-                if identities >= float(domains[uniacc][1]):
-                    # For each JASPAR matrix... #
-                    for matrix, gene_name in jaspar[uniacc]:
-                        # Infer matrix
-                        inference_results.setdefault((gene_name, matrix), identities)
-                        if identities > inference_results[(gene_name, matrix)]:
-                            inference_results[(gene_name, matrix)] = identities
+                if identities >= threshold:
+                    if max_identities is None or identities > max_identities:
+                        max_identities = identities
+            # Skip remaining domains (i.e. %ID cannot be higher than 100%)
+            if max_identities == 1.0: break
+        # If any domain satisfies the threshold...
+        if max_identities is not None:
+            # For each JASPAR matrix... #
+            for matrix, gene_name in matrices:
+                # Infer matrix
+                inference_results.setdefault((gene_name, matrix), max_identities)
 
     return [[i[0], i[1], inference_results[i]] for i in inference_results]
 
-def _pairwise_alignment(A, B):
+def _pairwise_alignment(A, B, profile=None):
     """
     This function returns the alignments between two sequences "A" and "B" using
-    dynamic programming.
+    dynamic programming. If available, uses the SIMD-vectorized aligner from
+    parasail (i.e. returns only the optimal alignment w/ the most identities),
+    reusing the query "profile" of "A" if provided.
     """
+    if parasail is not None:
+        if profile is None:
+            profile = _get_parasail_profile(str(A))
+        # Parameters from EMBOSS needle (i.e. doubled and weighted)
+        result = parasail.nw_trace_striped_profile_32(profile, str(B), 4096 * 20,
+            4096)
+        return [(result.traceback.query, result.traceback.ref)]
     try:
         # Parameters from EMBOSS needle
         return pairwise2.align.globalds(A, B, blosum62, -10.0, -0.5)
     except:
         return []
 
+@lru_cache(maxsize=32)
+def _get_parasail_profile(A):
+    """
+    This function returns the parasail query profile of sequence "A" (i.e. to
+    align "A" against several sequences). Profiles are cached, as the query is
+    aligned against the DBDs of each of its homologs.
+    """
+    return parasail.profile_create_32(A, parasail_blosum62)
+
 def _get_alignment_identities(A, B):
     """
     This function returns the number of identities between two aligned sequences "A"
     and "B". If "A" and "B" have different lengths, returns None.
     """
     if len(A) == len(B):
+        if njit is not None:
+            # i.e. zero-copy uint8 views of the encoded alignments
+            return _count_identities(numpy.frombuffer(A.encode(), numpy.uint8),
+                numpy.frombuffer(B.encode(), numpy.uint8))
         return len([i for i in range(len(A)) if A[i] == B[i]])
 
     return None
 
+if njit is not None:
+    @njit(cache=True)
+    def _count_identities(a, b):
+        """
+        This function returns the number of identical bytes between two arrays
+        of the same length "a" and "b" (i.e. JIT-compiled w/ Numba).
+        """
+        identities = 0
+        for i in range(a.shape[0]):
+            if a[i] == b[i]:
+                identities += 1
+        return identities
+
+    # Compile on import (i.e. rather than within the inference loop)
+    _count_identities(numpy.zeros(1, numpy.uint8), numpy.zeros(1, numpy.uint8))
+
 #-------------#
 # Main        #
 #-------------#